@@ -1,10 +1,12 @@
 import time
-import colorsys
 import os
 import sys
+import signal
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import socket
-import ST7735
-import datetime
 
 try:
     # Transitional fix for breaking change in LTR559
@@ -19,12 +21,10 @@ from pms5003 import PMS5003
 
 from bme280 import BME280
 from enviroplus import gas
-from subprocess import PIPE, Popen
-from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageFont
 
 from influxdb import InfluxDBClient
+from influxdb.exceptions import InfluxDBClientError, InfluxDBServerError
+from requests.exceptions import RequestException
 
 try:
     from smbus2 import SMBus
@@ -44,60 +44,63 @@ bme280 = BME280(i2c_dev=bus)
 #fvalent
 pms5003 = PMS5003()
 
-# Create ST7735 LCD display class
-st7735 = ST7735.ST7735(
-    port=0,
-    cs=1,
-    dc=9,
-    backlight=12,
-    rotation=270,
-    spi_speed_hz=10000000
-)
-
-# Initialize display
-st7735.begin()
-
-WIDTH = st7735.width
-HEIGHT = st7735.height
-
-# Set up canvas and font
-# img = Image.new('RGB', (WIDTH, HEIGHT), color=(0, 0, 0))
-# draw = ImageDraw.Draw(img)
-# path = os.path.dirname(os.path.realpath(__file__))
-# font = ImageFont.truetype(path + "/fonts/Asap/Asap-Bold.ttf", 20)
-
-# Set up InfluxDB
+# Set up InfluxDB. The client is kept for the life of the process and its
+# session holds a single keep-alive connection that is reused every cycle.
+# The timeout applies to its requests only, not to every socket in the process.
 influx = InfluxDBClient(host="192.168.100.7",
                         port="8086",
                         username="grafana",
                         password="grafana",
-                        database="urban")
+                        database="urban",
+                        pool_size=1,
+                        timeout=10,
+                        gzip=True)
 
 
-influx_json_prototyp = [
-        {
-            "measurement": "enviroplus",
-            "tags": {
-                "host": "enviroplus"
-            },
-            "fields": {
-            }
-        }
-    ]
+# Measurement and tags are the same for every point, so the start of each
+# line is built once
+LINE_PREFIX = "enviroplus,host=enviroplus "
+
+# Points that could not be written are appended here as line protocol,
+# one point per line, and replayed once InfluxDB is reachable again
+path = os.path.dirname(os.path.realpath(__file__))
+FAILED_DATA_FILE = os.path.join(path, "failed_data.lp")
+RETRY_BATCH_SIZE = 5000
+
+# After this many failed writes in a row, skip the next few writes and
+# save the points straight to disk instead
+MAX_CONSECUTIVE_FAILURES = 3
+BACKOFF_WRITES = 2
+consecutive_failures = 0
+skip_writes = 0
 
-# The position of the top bar
-top_pos = 25
+# Points are handed to a writer thread so that a slow or unreachable InfluxDB
+# never delays the sensor readings
+write_queue = queue.Queue(maxsize=1000)
+failed_data_lock = threading.Lock()
 
+# Points are sent in batches of up to BATCH_SIZE, and a batch is never held
+# longer than BATCH_MAX_AGE seconds. Set BATCH_SIZE to 1 to write every cycle.
+BATCH_SIZE = 10
+BATCH_MAX_AGE = 600
 
+# The batch the writer is currently sending, so it can still be saved if the
+# process exits before the write finishes
+in_flight = []
 
+# Whether there may be saved points to replay. Looked up on disk once at start
+# and then kept up to date, so an empty backlog costs no stat() calls per cycle.
+failed_data_pending = (os.path.exists(FAILED_DATA_FILE) or
+                       os.path.exists(FAILED_DATA_FILE + ".sending"))
 
 
+# The CPU temperature sysfs node is kept open and re-read from the start
+cpu_temp_fd = os.open('/sys/class/thermal/thermal_zone0/temp', os.O_RDONLY)
+
 # Get the temperature of the CPU for compensation
 def get_cpu_temperature():
-    process = Popen(['vcgencmd', 'measure_temp'], stdout=PIPE)
-    output, _error = process.communicate()
-    output = output.decode()
-    return float(output[output.index('=') + 1:output.rindex("'")])
+    os.lseek(cpu_temp_fd, 0, os.SEEK_SET)
+    return int(os.read(cpu_temp_fd, 16)) / 1000.0
 
 # Get local IP address
 def get_ip():
@@ -106,100 +109,287 @@ def get_ip():
         # doesn't even have to be reachable
         s.connect(('10.255.255.255', 1))
         IP = s.getsockname()[0]
-    except:
+    except OSError:
         IP = '127.0.0.1'
     finally:
         s.close()
     return IP
 
 
-# Tuning factor for compensation. Decrease this number to adjust the
-# temperature down, and increase to adjust up
-factor = 0.8
+# Format a field value, keeping integers typed as integers like the client does
+def format_field(value):
+    if isinstance(value, int):
+        return "{0}i".format(value)
+    return repr(float(value))
 
-cpu_temps = [0] * 5
 
-delay = 0.5  # Debounce the proximity tap
-mode = 0  # The starting mode
-last_page = 0
-light = 1
+# Build one line of InfluxDB line protocol from the fields and a ms timestamp
+def make_line(fields, timestamp):
+    field_set = ",".join("{0}={1}".format(k, format_field(v)) for k, v in fields.items())
+    return "{0}{1} {2}".format(LINE_PREFIX, field_set, timestamp)
 
 
+# Append points that could not be written to the failed data file
+def save_failed_data(lines):
+    global failed_data_pending
 
+    with failed_data_lock, open(FAILED_DATA_FILE, 'a', buffering=8192) as f:
+        f.write('\n'.join(lines) + '\n')
+        failed_data_pending = True
 
 
+# Send one batch of saved points. A batch the server refuses as bad data (400)
+# would be refused again on every replay, so it is set aside in a rejected
+# file. Other 4xx errors such as bad credentials or a missing database are
+# raised and handled like a failure to reach the server.
+def replay_batch(batch):
+    try:
+        influx.write_points(batch, time_precision='ms', protocol='line')
+    except InfluxDBClientError as e:
+        if e.code != 400:
+            raise
+        print("Saved points rejected, moving them aside: {0}".format(e))
+        with open(FAILED_DATA_FILE + ".rejected", 'a') as f:
+            f.write('\n'.join(batch) + '\n')
+
+
+# Replay the failed data file in batches. It is renamed first so that new
+# failures can be appended while it is being sent.
+def retry_failed_data():
+    global failed_data_pending
+
+    if not failed_data_pending:
+        return
+
+    sending = FAILED_DATA_FILE + ".sending"
+    if not os.path.exists(sending):
+        with failed_data_lock:
+            if not os.path.exists(FAILED_DATA_FILE):
+                failed_data_pending = False
+                return
+            os.rename(FAILED_DATA_FILE, sending)
+
+    with open(sending) as f:
+        batch = []
+        sent = False
+        try:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line:
+                    continue
+                batch.append(line)
+                if len(batch) >= RETRY_BATCH_SIZE:
+                    replay_batch(batch)
+                    sent = True
+                    batch = []
+            if batch:
+                replay_batch(batch)
+        except (RequestException, InfluxDBServerError, InfluxDBClientError):
+            if sent:
+                # Keep only the batches that have not been written yet
+                with open(sending + ".tmp", 'w') as tail:
+                    tail.writelines(line + '\n' for line in batch)
+                    tail.writelines(f)
+                os.replace(sending + ".tmp", sending)
+            raise
+
+    os.remove(sending)
+    with failed_data_lock:
+        failed_data_pending = os.path.exists(FAILED_DATA_FILE)
+
+
+# Write points to InfluxDB, or keep them on disk if the server can't be reached
+def send_to_influxdb(lines):
+    global consecutive_failures, skip_writes
+
+    if skip_writes > 0:
+        skip_writes -= 1
+        save_failed_data(lines)
+        return
+
+    try:
+        retry_failed_data()
+        influx.write_points(lines, time_precision='ms', protocol='line')
+        consecutive_failures = 0
+    except (RequestException, InfluxDBServerError, InfluxDBClientError) as e:
+        if isinstance(e, InfluxDBClientError) and e.code == 400:
+            # Bad data rather than a failed write, left to the writer
+            raise
+        print("Write failed, saving points: {0}".format(e))
+        save_failed_data(lines)
+        consecutive_failures += 1
+        if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+            print("Backing off for {0} writes".format(BACKOFF_WRITES))
+            skip_writes = BACKOFF_WRITES
+
+
+# Write queued points in the background, a batch at a time. None on the
+# queue makes the writer save what it is holding and stop.
+def writer():
+    global in_flight
+
+    while True:
+        line = write_queue.get()
+        if line is None:
+            return
+
+        lines = [line]
+        deadline = time.monotonic() + BATCH_MAX_AGE
+        while len(lines) < BATCH_SIZE:
+            try:
+                line = write_queue.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if line is None:
+                save_failed_data(lines)
+                return
+            lines.append(line)
+
+        # Keep the writer alive whatever goes wrong with one batch
+        in_flight = lines
+        try:
+            send_to_influxdb(lines)
+        except Exception as e:
+            print("Writer error, saving points: {0}".format(e))
+            try:
+                save_failed_data(lines)
+            except OSError as e:
+                print("Could not save points: {0}".format(e))
+        in_flight = []
+
+
+# Average of the last few values, kept as a running sum
+class RollingAverage:
+    def __init__(self, size, initial=0.0):
+        self._values = deque([initial] * size, maxlen=size)
+        self.total = initial * size
+
+    def append(self, value):
+        if len(self._values) == self._values.maxlen:
+            self.total -= self._values[0]
+        self._values.append(value)
+        self.total += value
+
+    @property
+    def avg(self):
+        return self.total / len(self._values)
+
+
+# Tuning factor for compensation. Decrease this number to adjust the
+# temperature down, and increase to adjust up
+factor = 0.8
 
-# Create a values dict to store the data
-variables = ["temperature",
-             "pressure",
-             "humidity",
-             "light",
-             "oxidised",
-             "reduced",
-             "nh3",
-             "pm010",
-             "pm025",
-             "pm100"]
+# Seconds between readings
+INTERVAL_SEC = 60
 
-values = {}
+cpu_temps = RollingAverage(5)
 
-for v in variables:
-    values[v] = [1] * WIDTH
+writer_thread = threading.Thread(target=writer, daemon=True)
+writer_thread.start()
+
+# The gas sensor and the PMS5003 (which waits on its serial port for a frame)
+# are read on worker threads so they overlap with the other sensors
+sensor_executor = ThreadPoolExecutor(max_workers=2)
+
+# systemd stops the logger with SIGTERM. Turn it into SystemExit so the
+# points still held in memory are saved on the way out.
+def handle_sigterm(signum, frame):
+    sys.exit(0)
+
+signal.signal(signal.SIGTERM, handle_sigterm)
 
 # The main loop
 try:
     iterations = 0
+    next_log_time = time.monotonic()
     while True:
-        current_time = datetime.datetime.utcnow().isoformat() + "Z"
+        timestamp = time.time_ns() // 1000000
+        gas_future = sensor_executor.submit(gas.read_all)
+        pms_future = sensor_executor.submit(pms5003.read)
         proximity = ltr559.get_proximity()
 
         # Compensated Temperature
         cpu_temp = get_cpu_temperature()
         # Smooth out with some averaging to decrease jitter
-        cpu_temps = cpu_temps[1:] + [cpu_temp]
-        avg_cpu_temp = sum(cpu_temps) / float(len(cpu_temps))
-        raw_temp = bme280.get_temperature()
+        cpu_temps.append(cpu_temp)
+        avg_cpu_temp = cpu_temps.avg
+        # One burst read of the BME280 gives temperature, pressure and humidity
+        bme280.update_sensor()
+        raw_temp = bme280.temperature
         compensated_temp = raw_temp - ((avg_cpu_temp - raw_temp) / factor)
 
-        # Change json
-        influx_json_prototyp[0]['fields']['ltr559.proximity'] = proximity
-
         if proximity < 10:
-            influx_json_prototyp[0]['fields']['ltr559.lux'] = ltr559.get_lux()
+            lux = ltr559.get_lux()
         else:
-            influx_json_prototyp[0]['fields']['ltr559.lux'] = 1.0
-
-        if iterations >= 6:
-            influx_json_prototyp[0]['fields']['bme280.temperature.raw'] = bme280.get_temperature()
-            influx_json_prototyp[0]['fields']['bme280.temperature.compensated'] = compensated_temp
-
-        influx_json_prototyp[0]['fields']['cpu.temperature'] = get_cpu_temperature()
-        influx_json_prototyp[0]['fields']['bme280.pressure'] = bme280.get_pressure()
-        influx_json_prototyp[0]['fields']['bme280.humidity'] = bme280.get_humidity()
-
-        gas_data = gas.read_all()
-        influx_json_prototyp[0]['fields']['mics6814.oxidising'] = gas_data.oxidising
-        influx_json_prototyp[0]['fields']['mics6814.reducing'] = gas_data.reducing
-        influx_json_prototyp[0]['fields']['mics6814.nh3'] = gas_data.nh3
+            lux = 1.0
 
+        gas_data = gas_future.result()
         #fvalent
-        data = pms5003.read()
-        influx_json_prototyp[0]['fields']['pms5003.pm010'] = data.pm_ug_per_m3(1.0)
-        influx_json_prototyp[0]['fields']['pms5003.pm025'] = data.pm_ug_per_m3(2.5)
-        influx_json_prototyp[0]['fields']['pms5003.pm100'] = data.pm_ug_per_m3(10)
-
-        influx_json_prototyp[0]['time'] = current_time  # ??????????
+        data = pms_future.result()
+
+        # Build all fields for this cycle in one go
+        fields = {
+            'ltr559.proximity': proximity,
+            'ltr559.lux': lux,
+            'cpu.temperature': cpu_temp,
+            'bme280.pressure': bme280.pressure,
+            'bme280.humidity': bme280.humidity,
+            'mics6814.oxidising': gas_data.oxidising,
+            'mics6814.reducing': gas_data.reducing,
+            'mics6814.nh3': gas_data.nh3,
+            'pms5003.pm010': data.pm_ug_per_m3(1.0),
+            'pms5003.pm025': data.pm_ug_per_m3(2.5),
+            'pms5003.pm100': data.pm_ug_per_m3(10),
+        }
 
+        if iterations >= 6:
+            fields['bme280.temperature.raw'] = raw_temp
+            fields['bme280.temperature.compensated'] = compensated_temp
 
         if iterations >= 3:
-            print("Write points: {0}".format(influx_json_prototyp))
-            influx.write_points(influx_json_prototyp, time_precision='ms')
+            line = make_line(fields, timestamp)
+            print("Write points: {0}".format(line))
+            try:
+                write_queue.put_nowait(line)
+            except queue.Full:
+                save_failed_data([line])
         else:
             print("Skip iteration: " + str(iterations))
 
-        time.sleep(60)
         iterations += 1
 
+        # Sleep until the next slot so the readings don't drift
+        next_log_time += INTERVAL_SEC
+        sleep_time = next_log_time - time.monotonic()
+        if sleep_time < -INTERVAL_SEC:
+            print("Cycle overran by {0:.1f}s, rescheduling".format(-sleep_time))
+            next_log_time = time.monotonic() + INTERVAL_SEC
+            sleep_time = INTERVAL_SEC
+        time.sleep(max(0, sleep_time))
+
 # Exit cleanly
 except KeyboardInterrupt:
     sys.exit(0)
+
+# However the loop ends, let the writer save its current batch, then keep
+# anything still queued
+finally:
+    try:
+        write_queue.put_nowait(None)
+    except queue.Full:
+        pass
+    writer_thread.join(timeout=15)
+
+    # If the writer is still busy, save the batch it is sending as well. Should
+    # that write succeed after all, replaying it later only overwrites the same
+    # points.
+    pending = list(in_flight) if writer_thread.is_alive() else []
+    try:
+        while True:
+            line = write_queue.get_nowait()
+            if line is not None:
+                pending.append(line)
+    except queue.Empty:
+        pass
+    if pending:
+        save_failed_data(pending)